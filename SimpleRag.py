@@ -1,23 +1,107 @@
 """
 Simple RAG (Retrieval Augmented Generation) Script
-Loads a document, chunks it, stores in FAISS, and answers questions using GPT-4.
+Loads a document, chunks it, stores in FAISS, and answers questions using GPT-4o-mini
+(escalating to GPT-4o when the smaller model can't answer).
 """
 
+import asyncio
+import contextlib
+import functools
+import hashlib
+import json
 import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 # Load environment variables from .env file (must be before using OPENAI_API_KEY)
 from dotenv import load_dotenv
 load_dotenv()
 
+# Each /query searches a single vector: OpenMP fork/join overhead outweighs the
+# parallel speedup, so run FAISS single-threaded (must be set before importing faiss)
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+
 import faiss
-from openai import AsyncOpenAI, OpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAI
+
+faiss.omp_set_num_threads(1)
 
 # -----------------------------------------------------------------------------
-# Lazy initialization: document and FAISS index are created on first query
+# Initialization: initialize_rag() runs once at startup (FastAPI lifespan or
+# the interactive script) and builds the document chunks and FAISS index
 # -----------------------------------------------------------------------------
 CHUNK_SIZE = 200  # Try 1000 for comparison
-_rag_initialized = False
+# Up to CHUNK_SIZE chars ending at whitespace (so words aren't split); hard split
+# only when a run has no whitespace at all
+_CHUNK_PATTERN = re.compile(rf".{{1,{CHUNK_SIZE - 1}}}(?:\s|$)|.{{1,{CHUNK_SIZE}}}", re.DOTALL)
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Matryoshka-truncated vectors: 512 instead of the default 1536 cuts index RAM and
+# per-search work ~3x for <1% recall loss. Part of every cache key, so vectors of
+# different sizes never mix.
+EMBEDDING_DIMENSIONS = 512
+_EMBED_CACHE_MODEL = f"{EMBEDDING_MODEL}@{EMBEDDING_DIMENSIONS}"
+EMBEDDING_BATCH_SIZE = 2048  # Max inputs per /v1/embeddings request
+# Max tokens per /v1/embeddings request is 300k; budget below it because tokens are
+# estimated as len(text) / 4 rather than counted exactly
+EMBEDDING_BATCH_TOKENS = 250_000
+
+# HNSW graph index: sub-linear search instead of brute-force IndexFlatL2
+HNSW_M = 32  # Neighbors per graph node
+HNSW_EF_CONSTRUCTION = 200  # Build-time search depth (higher = better graph, slower build)
+HNSW_EF_SEARCH = 64  # Query-time search depth (higher = better recall, slower search)
+
+# FAISS index_factory string. Small corpora: "Flat" or the HNSW default.
+# Millions of chunks: e.g. "IVF1024,PQ32x4fs" (4-bit PQ FastScan, 16 B/vector vs 2 KB;
+# needs enough vectors to train, roughly 39 per IVF list).
+RAG_INDEX_TYPE = os.getenv("RAG_INDEX_TYPE", f"HNSW{HNSW_M}")
+IVF_NPROBE = 16  # IVF lists scanned per query (higher = better recall, slower search)
+
+# On-disk caches so cold starts don't re-embed an unchanged document.
+# On Modal, RAG_CACHE_DIR points at a mounted Volume (see modal_app.py) so the cache
+# outlives the container; otherwise /root or the project directory (same rule as RagDocument.txt)
+CACHE_DIR = os.getenv("RAG_CACHE_DIR") or ("/root" if os.path.exists("/root/RagDocument.txt") else ".")
+CACHE_VOLUME = os.getenv("RAG_CACHE_VOLUME")  # Modal Volume name to commit after writes
+EMBED_CACHE_PATH = os.path.join(CACHE_DIR, "embed_cache.sqlite")
+INDEX_PATH = os.path.join(CACHE_DIR, "rag_index.faiss")
+CHUNKS_PATH = os.path.join(CACHE_DIR, "rag_chunks.json")
+
+# Answer generation cascade: the cheap, fast model first; if it says the context
+# doesn't answer the question, retry once with the larger model
+MODEL_PRIMARY = "gpt-4o-mini"
+MODEL_ESCALATE = "gpt-4o"
+_MODEL_CASCADE = (MODEL_PRIMARY, MODEL_ESCALATE)
+# Lowercased answer openings that count as "cannot answer from the context"
+_REFUSAL_PREFIXES = (
+    "i cannot",
+    "i can't",
+    "the context does not",
+    "the context doesn't",
+    "the provided context does not",
+    "the provided context doesn't",
+)
+_REFUSAL_CHECK_CHARS = max(len(p) for p in _REFUSAL_PREFIXES)
+
+WARM_UP_TIMEOUT = 5  # Seconds; warm_up() runs before the server accepts requests
+
+# Prompt pieces identical on every request: built once, and sent first so the stable
+# prefix stays cacheable. OpenAI's automatic prefix caching only kicks in for prompts
+# of 1024+ tokens, so at this prompt size it doesn't apply yet.
+SYSTEM_MESSAGE = """You are a helpful assistant. Answer the user's question based ONLY on the provided context.
+If the context doesn't contain the answer, say so. Be concise and accurate."""
+CONTEXT_PREAMBLE = "Context from the document:"
+_SYSTEM_PROMPT = {"role": "system", "content": SYSTEM_MESSAGE}
+
+# Answer cache for query_rag_async: exact question match, then semantic match
+ANSWER_CACHE_SIZE = 256  # Max cached answers (least recently used evicted first)
+ANSWER_CACHE_TTL = 3600  # Seconds before a cached answer expires
+SEMANTIC_CACHE_THRESHOLD = 0.97  # Min cosine similarity to reuse a prior question's answer
 
 # Set by initialize_rag(); used by get_embedding, query_rag, query_rag_async
 document_text = None
@@ -38,116 +122,513 @@ def initialize_rag():
         document_text = f.read()
     print("Document loaded successfully!")
 
+    # OpenAI clients (needed by queries even when the index comes from disk)
+    openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    # One shared HTTP/2 connection pool: concurrent requests multiplex over a single
+    # TCP+TLS connection instead of each paying for its own handshake.
+    # DefaultAsyncHttpxClient keeps the SDK's other defaults (timeout, redirects);
+    # the limits restate the SDK's own connection caps. Idle connections are kept
+    # for 2 minutes (httpx default: 5s) so the one opened by warm_up() is still
+    # there when traffic arrives.
+    async_openai_client = AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100, keepalive_expiry=120),
+        ),
+    )
+
+    # Fast path: document unchanged since last boot -> load chunks + FAISS index from disk
+    index_key = _index_cache_key(document_text)
+    persisted = _load_persisted_index(index_key)
+    if persisted is not None:
+        chunks, index = persisted
+        _configure_search(index)
+        print(f"Loaded {len(chunks)} chunks and FAISS index from disk cache!")
+        return
+
     # Chunk the document
-    chunks = []
-    for i in range(0, len(document_text), CHUNK_SIZE):
-        chunk = document_text[i : i + CHUNK_SIZE]
-        if chunk.strip():
-            chunks.append(chunk)
+    chunks = chunk_text(document_text)
     print(f"Chunks created: {len(chunks)}")
     for i, chunk in enumerate(chunks):
         print(f"  Chunk {i}: {len(chunk)} characters")
 
-    # OpenAI clients and FAISS index
-    openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    async_openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-    def get_embedding(text: str) -> list[float]:
-        """Get embedding vector for text using OpenAI's embedding API."""
-        response = openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text,
-        )
-        return response.data[0].embedding
-
-    chunk_embeddings = [get_embedding(chunk) for chunk in chunks]
-    embedding_array = np.array(chunk_embeddings).astype("float32")
+    # Embed (cached chunks are read from disk, only misses hit the API) and build FAISS index
+    chunk_embeddings = embed_with_cache(chunks)
+    # Already C-contiguous float32, so this is a no-op and FAISS won't re-copy on add()
+    embedding_array = np.ascontiguousarray(chunk_embeddings, dtype=np.float32)
     embedding_dim = embedding_array.shape[1]
-    index = faiss.IndexFlatL2(embedding_dim)
-    index.add(embedding_array)
-    print("Chunks stored in FAISS!")
-
-
-def get_embedding(text: str) -> list[float]:
-    """Get embedding vector for text using OpenAI's embedding API (requires initialize_rag first)."""
+    # Unit-length vectors + inner product = cosine similarity
+    faiss.normalize_L2(embedding_array)
+    index = faiss.index_factory(embedding_dim, RAG_INDEX_TYPE, faiss.METRIC_INNER_PRODUCT)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    # Bulk build is the one place multithreading pays off; restore single-thread for queries
+    faiss.omp_set_num_threads(os.cpu_count() or 1)
+    try:
+        if not index.is_trained:
+            # IVF centroids / PQ codebooks are learned from the vectors themselves
+            index.train(embedding_array)
+        index.add(embedding_array)
+    finally:
+        faiss.omp_set_num_threads(1)
+    _configure_search(index)
+    print(f"Chunks stored in FAISS ({RAG_INDEX_TYPE})!")
+    _persist_index(index_key, chunks, index)
+
+
+def chunk_text(text: str) -> list[str]:
+    """Split text into <= CHUNK_SIZE-char chunks at word boundaries, dropping whitespace-only chunks."""
+    return [m.group() for m in _CHUNK_PATTERN.finditer(text) if not m.group().isspace()]
+
+
+async def warm_up() -> None:
+    """
+    Open the shared HTTP/2 connection to OpenAI before the first request (requires
+    initialize_rag first), so no /query pays for DNS + TCP + TLS setup. The three model
+    lookups (embedding, primary, escalation) run concurrently and are free; failures
+    are logged, not raised.
+    Runs during startup, so it uses a short timeout and no retries: a slow OpenAI
+    delays the server by at most WARM_UP_TIMEOUT seconds.
+    """
+    client = async_openai_client.with_options(timeout=WARM_UP_TIMEOUT, max_retries=0)
+    results = await asyncio.gather(
+        client.models.retrieve(EMBEDDING_MODEL),
+        client.models.retrieve(MODEL_PRIMARY),
+        client.models.retrieve(MODEL_ESCALATE),
+        return_exceptions=True,
+    )
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        print(f"OpenAI warm-up failed: {errors[0]}")
+    else:
+        print("OpenAI connection warmed up!")
+
+
+async def close_rag() -> None:
+    """Close the shared async OpenAI HTTP connection pool (call on shutdown)."""
+    if async_openai_client is not None:
+        await async_openai_client.close()
+
+
+def _index_cache_key(text: str) -> str:
+    """Key for the persisted chunks + index: changes whenever the document or chunking/embedding setup does."""
+    return hashlib.sha256(f"{_EMBED_CACHE_MODEL}|{CHUNK_SIZE}:words|{RAG_INDEX_TYPE},IP|{text}".encode()).hexdigest()
+
+
+def _configure_search(faiss_index) -> None:
+    """Apply query-time parameters (not all survive write_index/read_index)."""
+    if isinstance(faiss_index, faiss.IndexHNSW):
+        faiss_index.hnsw.efSearch = HNSW_EF_SEARCH
+    ivf = faiss.try_extract_index_ivf(faiss_index)
+    if ivf is not None:
+        ivf.nprobe = IVF_NPROBE
+
+
+def _load_persisted_index(key: str):
+    """Return (chunks, index) saved by _persist_index for this key, or None if missing/stale."""
+    if not (os.path.exists(CHUNKS_PATH) and os.path.exists(INDEX_PATH)):
+        return None
+    try:
+        with open(CHUNKS_PATH, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved.get("key") != key:
+            return None
+        faiss_index = faiss.read_index(INDEX_PATH)
+        # Guard against an index and chunks file from different builds
+        if faiss_index.ntotal != len(saved["chunks"]):
+            print("Ignoring index cache: index and chunks file don't match")
+            return None
+        return saved["chunks"], faiss_index
+    except (OSError, ValueError, KeyError, RuntimeError) as e:
+        print(f"Ignoring unreadable index cache: {e}")
+        return None
+
+
+def _persist_index(key: str, chunk_list: list[str], faiss_index) -> None:
+    """
+    Save chunks + FAISS index so the next boot can skip chunking and embedding.
+    Both are written to temp files and swapped in with os.replace, chunks file (which
+    holds the key) last, so a failed write never pairs a new index with old chunks.
+    """
+    try:
+        faiss.write_index(faiss_index, INDEX_PATH + ".tmp")
+        with open(CHUNKS_PATH + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"key": key, "chunks": chunk_list}, f)
+        os.replace(INDEX_PATH + ".tmp", INDEX_PATH)
+        os.replace(CHUNKS_PATH + ".tmp", CHUNKS_PATH)
+    except (OSError, RuntimeError) as e:
+        print(f"Could not write index cache: {e}")
+        return
+    _commit_cache_volume()
+
+
+def _commit_cache_volume() -> None:
+    """On Modal, commit cache writes to the Volume so new containers can read them."""
+    if not CACHE_VOLUME:
+        return
+    try:
+        import modal
+
+        modal.Volume.from_name(CACHE_VOLUME).commit()
+    except Exception as e:
+        print(f"Could not commit cache volume: {e}")
+
+
+@functools.lru_cache(maxsize=1024)
+def get_embedding(text: str) -> tuple[float, ...]:
+    """
+    Get embedding vector for text using OpenAI's embedding API (requires initialize_rag first).
+    Memoized: repeat texts (e.g. the interactive display re-embedding the question) skip
+    the API. Returned as a tuple so cached results can't be mutated by callers.
+    """
     response = openai_client.embeddings.create(
-        model="text-embedding-3-small",
+        model=EMBEDDING_MODEL,
+        dimensions=EMBEDDING_DIMENSIONS,
         input=text,
     )
-    return response.data[0].embedding
+    return tuple(response.data[0].embedding)
+
+
+def embed_batch(texts: list[str]) -> np.ndarray:
+    """
+    Embed many texts with as few API calls as possible (requires initialize_rag first).
+    The embeddings endpoint accepts a list input, so one request replaces N round-trips.
+    Returns a (len(texts), dim) float32 array filled in place—no list-of-lists staging copy.
+    """
+    def embed_sub_batch(bounds: tuple[int, int]):
+        start, end = bounds
+        return openai_client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            dimensions=EMBEDDING_DIMENSIONS,
+            input=texts[start:end],
+        )
+
+    # Usually a single request; sub-batches (split by input count and estimated tokens)
+    # run concurrently
+    batches = _split_batches(texts)
+    starts = [start for start, _ in batches]
+    with ThreadPoolExecutor(max_workers=min(len(batches), 8) or 1) as pool:
+        responses = list(pool.map(embed_sub_batch, batches))
+
+    embeddings = None
+    for start, response in zip(starts, responses):
+        if embeddings is None:
+            embeddings = np.empty((len(texts), len(response.data[0].embedding)), dtype=np.float32)
+        # d.index is the position within this batch, so rows land in input order
+        for d in response.data:
+            embeddings[start + d.index] = d.embedding
+    return embeddings
+
+
+def _split_batches(texts: list[str]) -> list[tuple[int, int]]:
+    """(start, end) ranges that stay under EMBEDDING_BATCH_SIZE inputs and EMBEDDING_BATCH_TOKENS tokens."""
+    batches = []
+    start, tokens = 0, 0
+    for i, text in enumerate(texts):
+        text_tokens = len(text) // 4 + 1
+        if i > start and (i - start >= EMBEDDING_BATCH_SIZE or tokens + text_tokens > EMBEDDING_BATCH_TOKENS):
+            batches.append((start, i))
+            start, tokens = i, 0
+        tokens += text_tokens
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
+def embed_with_cache(texts: list[str]) -> np.ndarray:
+    """
+    Embed texts, reading/writing a SQLite cache keyed by (sha256(text), model@dimensions).
+    Only cache misses are sent to the API (in one batched call via embed_batch).
+    """
+    hashes = [hashlib.sha256(text.encode()).hexdigest() for text in texts]
+    with contextlib.closing(sqlite3.connect(EMBED_CACHE_PATH)) as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "hash TEXT NOT NULL, model TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (hash, model))"
+        )
+        cached = {}
+        for h in set(hashes):
+            row = conn.execute(
+                "SELECT vector FROM embeddings WHERE hash = ? AND model = ?",
+                (h, _EMBED_CACHE_MODEL),
+            ).fetchone()
+            if row is not None:
+                cached[h] = np.frombuffer(row[0], dtype=np.float32)
+
+        # Unique texts not in the cache (dict keeps first-seen order)
+        misses = {h: text for h, text in zip(hashes, texts) if h not in cached}
+        print(f"Embedding cache: {len(hashes) - len(misses)} hits, {len(misses)} misses")
+        if misses:
+            vectors = embed_batch(list(misses.values()))
+            rows = []
+            for h, vec in zip(misses, vectors):
+                cached[h] = vec
+                rows.append((h, _EMBED_CACHE_MODEL, vec.tobytes()))
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (hash, model, vector) VALUES (?, ?, ?)",
+                    rows,
+                )
+            _commit_cache_volume()
+
+    # Preallocate the float32 matrix and fill row-wise (one copy per vector)
+    embedding_array = np.empty((len(hashes), len(cached[hashes[0]])), dtype=np.float32)
+    for i, h in enumerate(hashes):
+        embedding_array[i] = cached[h]
+    return embedding_array
+
+
+def _query_vector(embedding) -> np.ndarray:
+    """Shape a single embedding as a (1, d) float32 row, L2-normalized to match the index."""
+    question_embedding = np.array([embedding]).astype("float32")
+    faiss.normalize_L2(question_embedding)
+    return question_embedding
 
 
 def query_rag(question: str, max_results: int = 3) -> tuple[str, list[str]]:
     """
     Query the RAG system with a question and return the answer plus source chunks.
-    Used by both the interactive script and the FastAPI app.
+    Used by the interactive script (requires initialize_rag first).
     """
-    global _rag_initialized
-    if not _rag_initialized:
-        initialize_rag()
-        _rag_initialized = True
-
     # Embed the question and search FAISS for top k similar chunks
-    question_embedding = np.array([get_embedding(question)]).astype("float32")
+    question_embedding = _query_vector(get_embedding(question))
     k = min(max_results, len(chunks))
     distances, indices = index.search(question_embedding, k)
 
-    # Use indices to get the actual chunk texts (sorted by relevance)
-    retrieved_chunks = [chunks[i] for i in indices[0]]
+    # Use indices to get the actual chunk texts (sorted by relevance; -1 = fewer than k found)
+    retrieved_chunks = [chunks[i] for i in indices[0] if i != -1]
 
-    # Build context from retrieved chunks
-    context = "\n\n---\n\n".join(retrieved_chunks)
+    messages = _build_messages(question, retrieved_chunks)
+    for model in _MODEL_CASCADE:
+        response = openai_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0,
+        )
+        answer = response.choices[0].message.content
+        if not _is_refusal(answer):
+            break
 
-    system_message = """You are a helpful assistant. Answer the user's question based ONLY on the provided context.
-If the context doesn't contain the answer, say so. Be concise and accurate."""
+    return answer, retrieved_chunks
 
-    user_message = f"""Context from the document:
 
-{context}
+def _is_refusal(answer: str) -> bool:
+    """True if the answer opens by saying the context doesn't contain it (triggers escalation)."""
+    # content is None when generation stops early (e.g. content filter)
+    return (answer or "").lstrip().lower().startswith(_REFUSAL_PREFIXES)
 
----
 
-Question: {question}
+# -----------------------------------------------------------------------------
+# Answer cache (used by query_rag_async)
+# -----------------------------------------------------------------------------
+# Entries: id -> (question, max_results, answer, sources, stored_at), in LRU order.
+# Prior question embeddings live in a small IndexFlatIP keyed by the same ids.
+_answer_cache = OrderedDict()
+_answer_cache_ids = {}  # (question, max_results) -> id, for exact-match lookups
+_answer_cache_index = None
+_answer_cache_next_id = 0
+_inflight = {}  # (question, max_results) -> Task, so concurrent duplicates share one call
+
+
+def _answer_cache_evict(entry_id: int) -> None:
+    """Remove one entry from the dict, the exact-match map and the semantic index."""
+    question, max_results, *_ = _answer_cache.pop(entry_id)
+    _answer_cache_ids.pop((question, max_results), None)
+    _answer_cache_index.remove_ids(np.array([entry_id], dtype=np.int64))
+
+
+def _answer_cache_fresh(entry_id: int):
+    """Return the (answer, sources) for entry_id if it hasn't expired, marking it recently used."""
+    *_, answer, sources, stored_at = _answer_cache[entry_id]
+    if time.monotonic() - stored_at > ANSWER_CACHE_TTL:
+        _answer_cache_evict(entry_id)
+        return None
+    _answer_cache.move_to_end(entry_id)
+    return answer, sources
+
+
+def _answer_cache_lookup_exact(question: str, max_results: int):
+    """Return the cached (answer, sources) for this exact question, or None."""
+    entry_id = _answer_cache_ids.get((question, max_results))
+    return None if entry_id is None else _answer_cache_fresh(entry_id)
+
+
+def _answer_cache_lookup_semantic(question_embedding: np.ndarray, max_results: int):
+    """Reuse the answer of a near-identical prior question (cosine >= SEMANTIC_CACHE_THRESHOLD)."""
+    if _answer_cache_index is None or _answer_cache_index.ntotal == 0:
+        return None
+    k = min(5, _answer_cache_index.ntotal)
+    similarities, ids = _answer_cache_index.search(question_embedding, k)
+    for similarity, entry_id in zip(similarities[0], ids[0].tolist()):
+        if entry_id == -1 or similarity < SEMANTIC_CACHE_THRESHOLD:
+            break
+        if _answer_cache[entry_id][1] == max_results:
+            hit = _answer_cache_fresh(entry_id)
+            if hit is not None:
+                return hit
+    return None
+
+
+def _answer_cache_store(question: str, max_results: int, question_embedding: np.ndarray, answer: str, sources: list[str]) -> None:
+    """Add an answer to the cache, evicting the least recently used entries when full."""
+    global _answer_cache_index, _answer_cache_next_id
+    if _answer_cache_index is None:
+        _answer_cache_index = faiss.IndexIDMap2(faiss.IndexFlatIP(question_embedding.shape[1]))
+    old_id = _answer_cache_ids.get((question, max_results))
+    if old_id is not None:
+        _answer_cache_evict(old_id)
+    while len(_answer_cache) >= ANSWER_CACHE_SIZE:
+        _answer_cache_evict(next(iter(_answer_cache)))
+
+    entry_id = _answer_cache_next_id
+    _answer_cache_next_id += 1
+    _answer_cache[entry_id] = (question, max_results, answer, sources, time.monotonic())
+    _answer_cache_ids[(question, max_results)] = entry_id
+    _answer_cache_index.add_with_ids(question_embedding, np.array([entry_id], dtype=np.int64))
 
-Answer:"""
 
-    response = openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": user_message}
-        ]
-    )
+async def query_rag_async(question: str, max_results: int = 3) -> tuple[str, list[str]]:
+    """
+    Async version of query_rag for FastAPI. Uses AsyncOpenAI so API calls
+    don't block the event loop—multiple concurrent requests can run in parallel.
+    Repeated questions are answered from the answer cache; identical questions
+    arriving concurrently share a single in-flight OpenAI call.
+    """
+    cached = _answer_cache_lookup_exact(question, max_results)
+    if cached is not None:
+        return cached
+
+    key = (question, max_results)
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_query_rag_uncached(question, max_results))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: one client disconnecting must not cancel the call other requests await
+    return await asyncio.shield(task)
+
+
+async def _query_rag_uncached(question: str, max_results: int) -> tuple[str, list[str]]:
+    question_embedding, retrieved_chunks, cached = await _retrieve_async(question, max_results)
+    if cached is not None:
+        return cached
+
+    messages = _build_messages(question, retrieved_chunks)
+    for model in _MODEL_CASCADE:
+        # await: non-blocking chat completion—typically 1–5 seconds of I/O
+        response = await async_openai_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0,
+        )
+        answer = response.choices[0].message.content
+        if not _is_refusal(answer):
+            break
 
-    answer = response.choices[0].message.content
+    _answer_cache_store(question, max_results, question_embedding, answer, retrieved_chunks)
     return answer, retrieved_chunks
 
 
-async def query_rag_async(question: str, max_results: int = 3) -> tuple[str, list[str]]:
+async def query_rag_stream(question: str, max_results: int = 3) -> tuple[list[str], AsyncIterator[str]]:
     """
-    Async version of query_rag for FastAPI. Uses AsyncOpenAI so API calls
-    don't block the event loop—multiple concurrent requests can run in parallel.
+    Streaming version of query_rag_async. Returns the source chunks as soon as
+    retrieval finishes, plus an async iterator of answer tokens—callers can show
+    the first tokens while the model is still generating the rest.
     """
-    global _rag_initialized
-    if not _rag_initialized:
-        initialize_rag()
-        _rag_initialized = True
+    cached = _answer_cache_lookup_exact(question, max_results)
+    if cached is None:
+        question_embedding, retrieved_chunks, cached = await _retrieve_async(question, max_results)
+    if cached is not None:
+        answer, sources = cached
+        return sources, _iterate_cached(answer)
+    return retrieved_chunks, _stream_answer(question, max_results, question_embedding, retrieved_chunks)
+
 
+async def _iterate_cached(answer: str) -> AsyncIterator[str]:
+    yield answer
+
+
+async def _stream_answer(question: str, max_results: int, question_embedding: np.ndarray, retrieved_chunks: list[str]) -> AsyncIterator[str]:
+    """
+    Yield answer tokens from a streamed chat completion; cache the full answer once complete.
+    Tokens from MODEL_PRIMARY are held back until the opening is long enough to rule out a
+    refusal—on a refusal that stream is dropped and MODEL_ESCALATE streams instead.
+    """
+    messages = _build_messages(question, retrieved_chunks)
+    for model in _MODEL_CASCADE:
+        stream = await async_openai_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0,
+            stream=True,
+        )
+        parts = []
+        # Last model in the cascade: nothing to escalate to, so stream straight through
+        releasing = model == _MODEL_CASCADE[-1]
+        refused = False
+        try:
+            async for chunk in stream:
+                if not (chunk.choices and chunk.choices[0].delta.content):
+                    continue
+                token = chunk.choices[0].delta.content
+                parts.append(token)
+                if releasing:
+                    yield token
+                elif len("".join(parts).lstrip()) >= _REFUSAL_CHECK_CHARS:
+                    refused = _is_refusal("".join(parts))
+                    if refused:
+                        break
+                    releasing = True
+                    yield "".join(parts)
+
+            if not releasing and not refused:
+                # Whole answer arrived before the refusal check length
+                refused = _is_refusal("".join(parts))
+                if not refused:
+                    yield "".join(parts)
+        finally:
+            # Also runs when the client disconnects and the generator is closed at a
+            # yield—otherwise the upstream completion keeps generating
+            await stream.close()
+        if not refused:
+            break
+
+    _answer_cache_store(question, max_results, question_embedding, "".join(parts), retrieved_chunks)
+
+
+async def _retrieve_async(question: str, max_results: int):
+    """
+    Embed the question and search FAISS. Returns (question_embedding, retrieved_chunks, cached),
+    where cached is a semantic answer-cache hit (answer, sources) or None.
+    """
     # await: non-blocking embedding call—event loop can handle other requests
     response = await async_openai_client.embeddings.create(
-        model="text-embedding-3-small",
+        model=EMBEDDING_MODEL,
+        dimensions=EMBEDDING_DIMENSIONS,
         input=question,
     )
-    question_embedding = np.array([response.data[0].embedding]).astype("float32")
+    question_embedding = _query_vector(response.data[0].embedding)
+
+    # Near-duplicate of a recent question: skip retrieval and the chat completion
+    cached = _answer_cache_lookup_semantic(question_embedding, max_results)
+    if cached is not None:
+        return question_embedding, None, cached
 
     k = min(max_results, len(chunks))
     distances, indices = index.search(question_embedding, k)
-    retrieved_chunks = [chunks[i] for i in indices[0]]
+    retrieved_chunks = [chunks[i] for i in indices[0] if i != -1]
+    return question_embedding, retrieved_chunks, None
+
 
+def _build_messages(question: str, retrieved_chunks: list[str]) -> list[dict]:
+    """
+    Chat messages asking the model to answer the question from the retrieved chunks only.
+    Stable content comes first so OpenAI's automatic prefix caching can reuse it.
+    """
     context = "\n\n---\n\n".join(retrieved_chunks)
-    system_message = """You are a helpful assistant. Answer the user's question based ONLY on the provided context.
-If the context doesn't contain the answer, say so. Be concise and accurate."""
-    user_message = f"""Context from the document:
+    user_message = f"""{CONTEXT_PREAMBLE}
 
 {context}
 
@@ -156,30 +637,23 @@ If the context doesn't contain the answer, say so. Be concise and accurate."""
 Question: {question}
 
 Answer:"""
-
-    # await: non-blocking chat completion—typically 1–5 seconds of I/O
-    response = await async_openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": user_message},
-        ],
-    )
-
-    answer = response.choices[0].message.content
-    return answer, retrieved_chunks
+    return [
+        _SYSTEM_PROMPT,
+        {"role": "user", "content": user_message},
+    ]
 
 
 # -----------------------------------------------------------------------------
 # INTERACTIVE MODE (run as script)
 # -----------------------------------------------------------------------------
 if __name__ == "__main__":
+    initialize_rag()
     user_question = input("\nAsk a question about the document: ")
     answer, retrieved_chunks = query_rag(user_question)
 
     # Display retrieved chunks
     SEPARATOR = "═" * 60
-    question_embedding = np.array([get_embedding(user_question)]).astype("float32")
+    question_embedding = _query_vector(get_embedding(user_question))
     k = min(3, len(chunks))
     distances, indices = index.search(question_embedding, k)
 
@@ -187,11 +661,15 @@ if __name__ == "__main__":
     print("  RETRIEVED CHUNKS")
     print(f"{SEPARATOR}\n")
 
-    for rank, idx in enumerate(indices[0], start=1):
-        l2_distance = distances[0][rank - 1]
-        similarity = 1.0 / (1.0 + l2_distance)
+    # Inner product of unit vectors is the cosine similarity itself; one vector op for all k
+    similarities = distances[0]
+    cosine_distances = 1.0 - similarities
+
+    for rank, (idx, similarity, cosine_distance) in enumerate(zip(indices[0], similarities, cosine_distances), start=1):
+        if idx == -1:
+            continue
         print(f"  ┌─ Chunk #{rank} (index {idx})")
-        print(f"  │  Similarity: {similarity:.2%}  |  L2 distance: {l2_distance:.4f}  |  {len(chunks[idx])} chars")
+        print(f"  │  Similarity: {similarity:.2%}  |  Cosine distance: {cosine_distance:.4f}  |  {len(chunks[idx])} chars")
         print(f"  │")
         print(f"  │  Text:")
         for line in chunks[idx].splitlines():
@@ -5,22 +5,55 @@ Provides a REST API for querying documents with retrieval-augmented generation.
 
 import os
 import uuid
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, HTTPException
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+import orjson
 from pydantic import BaseModel, Field
 
+from SimpleRag import close_rag, initialize_rag, query_rag_async, query_rag_stream, warm_up
+
 # -----------------------------------------------------------------------------
 # 1. FastAPI app instance
 # -----------------------------------------------------------------------------
+# lifespan: runs once when the server (or Modal container) starts, before the
+# first request is accepted—so no request pays for loading the document,
+# embedding chunks and building the FAISS index.
+#
+# If initialization fails (missing OPENAI_API_KEY, OpenAI outage on a cache
+# miss, ...) the server still starts: /query returns 503 and /health reports
+# "degraded" with the reason.
+rag_init_error = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global rag_init_error
+    try:
+        initialize_rag()
+    except Exception as e:
+        rag_init_error = str(e)
+        print(f"RAG initialization failed: {rag_init_error}")
+    else:
+        # Connection setup happens here, off the first request's critical path
+        await warm_up()
+    yield
+    await close_rag()
+
+
 # Create the FastAPI application. The app handles routing, validation, and
-# automatic OpenAPI documentation at /docs.
+# automatic OpenAPI documentation at /docs. JSON responses keep the default
+# response class: with response_model set, FastAPI serializes them straight
+# from Pydantic (Rust), which is faster than routing them through ORJSONResponse.
 app = FastAPI(
     title="RAG Query API",
     description="Query documents using Retrieval Augmented Generation",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # -----------------------------------------------------------------------------
@@ -58,13 +91,35 @@ class QueryResponse(BaseModel):
 # -----------------------------------------------------------------------------
 # async def: FastAPI can handle multiple /query requests concurrently. While one
 # request awaits OpenAI, others can start—no thread pool or blocking.
-@app.post("/query", response_model=QueryResponse)
-async def query(request: QueryRequest):
+#
+# By default the answer is streamed as Server-Sent Events: a "sources" event
+# (with request_id) as soon as retrieval finishes, then one "token" event per
+# answer fragment, then "done". Pass ?stream=false for a single QueryResponse JSON.
+@app.post(
+    "/query",
+    response_model=QueryResponse,
+    responses={200: {"content": {"text/event-stream": {}}}},
+)
+async def query(request: QueryRequest, stream: bool = True):
     request_id = str(uuid.uuid4())
 
+    if rag_init_error is not None:
+        raise HTTPException(
+            status_code=503,
+            detail=f"RAG system unavailable: {rag_init_error}",
+        )
+
     try:
-        # Import here to defer RAG initialization until first request
-        from SimpleRag import query_rag_async
+        if stream:
+            # await: only retrieval happens here; generation streams afterwards
+            sources, tokens = await query_rag_stream(
+                question=request.question,
+                max_results=request.max_results,
+            )
+            return StreamingResponse(
+                _sse_events(request_id, sources, tokens),
+                media_type="text/event-stream",
+            )
 
         # await: yields control during OpenAI I/O; other requests can run
         answer, sources = await query_rag_async(
@@ -86,12 +141,31 @@ async def query(request: QueryRequest):
         )
 
 
+def _sse(event: str, data) -> str:
+    """Format one Server-Sent Event with a JSON payload (JSON keeps newlines in tokens intact)."""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+async def _sse_events(request_id: str, sources: list[str], tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+    yield _sse("sources", {"sources": sources, "request_id": request_id})
+    try:
+        async for token in tokens:
+            yield _sse("token", token)
+    except Exception as e:
+        # Headers are already sent, so report OpenAI failures in-band
+        yield _sse("error", {"detail": f"OpenAI service error: {str(e)}"})
+        return
+    yield _sse("done", {"request_id": request_id})
+
+
 # -----------------------------------------------------------------------------
-# 5. GET /health endpoint (sync—no I/O, fast env check)
+# 5. GET /health endpoint (sync—no I/O, fast env + startup check)
 # -----------------------------------------------------------------------------
 # def (sync): os.getenv is instant; no benefit from async here.
 @app.get("/health")
 def health():
+    if rag_init_error is not None:
+        return {"status": "degraded", "detail": rag_init_error}
     api_key = os.getenv("OPENAI_API_KEY")
     if api_key and api_key.strip():
         return {"status": "healthy"}
@@ -116,3 +190,17 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+
+
+# -----------------------------------------------------------------------------
+# 7. Local server (python api.py)
+# -----------------------------------------------------------------------------
+# uvicorn's default loop="auto"/http="auto" picks uvloop (libuv event loop) and
+# httptools (C HTTP parser) when installed, falling back to pure-Python
+# asyncio/h11 otherwise (e.g. no uvloop on Windows). uvicorn[standard] in
+# requirements.txt is what installs them. Equivalent CLI:
+#   uvicorn api:app --workers 1
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("api:app", host="127.0.0.1", port=8000, workers=1)
@@ -7,11 +7,12 @@ import asyncio
 import time
 
 import aiohttp
+import orjson
 
 # -----------------------------------------------------------------------------
 # Configuration
 # -----------------------------------------------------------------------------
-API_ENDPOINT = "http://127.0.0.1:8000/query"
+API_ENDPOINT = "http://127.0.0.1:8000/query?stream=false"  # Whole JSON response, not SSE
 NUM_REQUESTS = 10
 QUESTION = "What does ShopifyAudit do?"
 PAYLOAD = {"question": QUESTION, "max_results": 3}
@@ -22,7 +23,7 @@ async def fetch_one(session: aiohttp.ClientSession) -> tuple[float | None, str |
     start = time.perf_counter()
     try:
         async with session.post(API_ENDPOINT, json=PAYLOAD) as resp:
-            await resp.json()
+            orjson.loads(await resp.read())
             if resp.status != 200:
                 return None, f"HTTP {resp.status}"
         return time.perf_counter() - start, None
@@ -30,6 +31,8 @@ async def fetch_one(session: aiohttp.ClientSession) -> tuple[float | None, str |
         return None, str(e)
     except asyncio.TimeoutError:
         return None, "timeout"
+    except orjson.JSONDecodeError:
+        return None, "invalid JSON response"
 
 
 async def run_benchmark() -> list[tuple[float | None, str | None]]:
@@ -17,7 +17,17 @@ app = modal.App("rag-api")
 
 
 # -----------------------------------------------------------------------------
-# 2. Modal Image
+# 2. Persistent cache Volume
+# -----------------------------------------------------------------------------
+# Container filesystems are discarded with the container, so the embedding cache
+# and saved FAISS index live on a Volume mounted at /cache. New containers load
+# them instead of re-embedding the whole document.
+CACHE_VOLUME_NAME = "rag-cache"
+cache_volume = modal.Volume.from_name(CACHE_VOLUME_NAME, create_if_missing=True)
+
+
+# -----------------------------------------------------------------------------
+# 3. Modal Image
 # -----------------------------------------------------------------------------
 # The Image defines the container environment: base OS + pip packages.
 # Local files are copied into the image at build time.
@@ -25,8 +35,10 @@ image = (
     modal.Image.debian_slim()
     .pip_install(
         "fastapi",
-        "uvicorn",
+        "orjson",
+        "uvicorn[standard]",
         "openai",
+        "httpx[http2]",
         "faiss-cpu",
         "pydantic",
         "langchain",
@@ -34,6 +46,13 @@ image = (
         "langchain-community",
         "python-dotenv",
     )
+    # Single-query FAISS searches are faster without OpenMP threading;
+    # RAG_CACHE_* tell SimpleRag.py where the cache Volume is mounted
+    .env({
+        "OMP_NUM_THREADS": "1",
+        "RAG_CACHE_DIR": "/cache",
+        "RAG_CACHE_VOLUME": CACHE_VOLUME_NAME,
+    })
     .add_local_file("api.py", remote_path="/root/api.py", copy=True)
     .add_local_file("SimpleRag.py", remote_path="/root/SimpleRag.py", copy=True)
     .add_local_file("RagDocument.txt", remote_path="/root/RagDocument.txt", copy=True)
@@ -41,7 +60,7 @@ image = (
 
 
 # -----------------------------------------------------------------------------
-# 3. ASGI FastAPI deployment
+# 4. ASGI FastAPI deployment
 # -----------------------------------------------------------------------------
 # @app.function:
 #   - Declares a Modal function that can be invoked remotely.
@@ -75,6 +94,7 @@ def debug_files():
 @app.function(
     image=image,
     secrets=[modal.Secret.from_name("openai-secret")],
+    volumes={"/cache": cache_volume},
 )
 @modal.asgi_app()
 def fastapi_app():
@@ -82,6 +102,8 @@ def fastapi_app():
     Entrypoint for the FastAPI ASGI app on Modal.
 
     Modal will call this once per container to get the ASGI application object.
+    Modal runs the app's lifespan startup when the container boots, so the RAG
+    index is built once per container, before the first request is routed to it.
     """
     import sys
 
@@ -92,7 +114,7 @@ def fastapi_app():
 
 
 # -----------------------------------------------------------------------------
-# 4. Local entrypoint for development
+# 5. Local entrypoint for development
 # -----------------------------------------------------------------------------
 # @app.local_entrypoint:
 #   - Runs on your local machine when you execute: